@@ -1,6 +1,7 @@
 import io
+from dataclasses import asdict
 from datetime import date, datetime
-from typing import Tuple, List, Dict, Any, Optional
+from typing import Tuple, List, Dict, Any, Optional, BinaryIO, Iterable, Union
 
 import pandas as pd
 from openpyxl import Workbook
@@ -20,6 +21,8 @@ SETTINGS_SHEET_NAME = "Настройки заказа"
 
 INPUT_SHEET_NAMES = ("Ввод данных", "Ввод", "Input")
 INTRANSIT_SHEET_NAMES = ("InTransit", "Товары в пути")
+# Листы результата: build_output пишет их заново, поэтому при повторной загрузке они не читаются
+OUTPUT_SHEET_NAMES = ("Recommendations", "Рекомендации", "Log", "Заказ на фабрику")
 
 # Отображения колонок листа Recommendations
 RECOMMENDATION_COLUMN_ALIASES = {
@@ -130,6 +133,10 @@ OPTIONAL_SETTINGS_FLOAT_COLS = [
 class BadTemplateError(Exception): ...
 
 
+# Исходная книга: байты, файловый объект или уже прочитанные листы (см. read_sheets)
+ExcelSource = Union[bytes, BinaryIO, Dict[str, pd.DataFrame]]
+
+
 def _ensure_columns(
     df: pd.DataFrame,
     required: List[str],
@@ -145,6 +152,16 @@ def _ensure_columns(
 
 
 def _is_blank(value: Any) -> bool:
+    # Быстрые ветки для типичных ячеек; pd.isna — только для прочих типов (NaT, numpy и т.п.)
+    if value is None:
+        return True
+    value_type = type(value)
+    if value_type is str:
+        return not value.strip()
+    if value_type is int:
+        return False
+    if value_type is float:
+        return value != value
     if pd.isna(value):
         return True
     if isinstance(value, str) and not value.strip():
@@ -152,6 +169,13 @@ def _is_blank(value: Any) -> bool:
     return False
 
 
+def _is_blank_row(row: Dict[str, Any]) -> bool:
+    for value in row.values():
+        if not _is_blank(value):
+            return False
+    return True
+
+
 def _parse_int(value: Any, *, sheet: str, column: str, sku: Optional[str] = None) -> int:
     if _is_blank(value):
         target = f" для SKU '{sku}'" if sku else ""
@@ -180,6 +204,35 @@ def _parse_float(value: Any, *, sheet: str, column: str, sku: str) -> float:
         )
 
 
+# --- Нормализация SKU: удаляем неразрывные пробелы, выравниваем регистр, заменяем длинные дефисы ---
+def _normalize_sku(s: Any) -> Any:
+    if not isinstance(s, str):
+        return s
+    # 1) базовая чистка: обрезка, неразрывные пробелы, длинные дефисы, регистр
+    s = (
+        s.strip()
+        .replace("\xa0", " ")
+        .replace("–", "-")
+        .replace("—", "-")
+        .lower()
+    )
+    # 2) убрать пробелы вокруг слэша: " / ", " /", "/ " -> "/"
+    s = s.replace(" / ", "/").replace(" /", "/").replace("/ ", "/")
+    # 3) схлопнуть лишние пробелы (в т.ч. табы/множественные)
+    s = " ".join(s.split())
+    return s
+
+
+def _parse_eta_column(values: pd.Series) -> pd.Series:
+    # Быстрый путь: колонка только из ISO-строк (YYYY-MM-DD) и ячеек-дат разбирается без угадывания формата.
+    # Если хоть одна непустая ячейка не разобралась (например, 01.11.2025) — прежний универсальный
+    # разбор всей колонки целиком, чтобы формат угадывался так же, как раньше
+    parsed = pd.to_datetime(values, format="ISO8601", errors="coerce")
+    if (parsed.isna() & values.notna()).any():
+        parsed = pd.to_datetime(values, errors="coerce")
+    return parsed.dt.date
+
+
 def _read_settings(df_settings: pd.DataFrame) -> Dict[str, Any]:
     # Считываем первую заполненную строку с общими параметрами заказа
     _ensure_columns(
@@ -235,52 +288,67 @@ def _read_settings(df_settings: pd.DataFrame) -> Dict[str, Any]:
             settings[key] = 1.0
     return settings
 
-def read_input(xlsx_bytes: bytes) -> Tuple[List[SkuInput], List[InTransitItem]]:
-    xl = pd.ExcelFile(io.BytesIO(xlsx_bytes))
-    input_sheet_name = next((name for name in INPUT_SHEET_NAMES if name in xl.sheet_names), None)
+def _open_source(xlsx: Union[bytes, BinaryIO]) -> BinaryIO:
+    # Байты оборачиваем в BytesIO, файловый объект (например, SpooledTemporaryFile
+    # из UploadFile) читаем напрямую, не копируя загрузку целиком в память
+    if isinstance(xlsx, (bytes, bytearray)):
+        return io.BytesIO(xlsx)
+    xlsx.seek(0)
+    return xlsx
+
+
+def read_sheets(
+    xlsx: ExcelSource,
+    skip: Iterable[str] = OUTPUT_SHEET_NAMES,
+) -> Dict[str, pd.DataFrame]:
+    """Читает листы книги один раз (кроме skip); результат можно передавать в read_input и build_output."""
+
+    if isinstance(xlsx, dict):
+        return xlsx
+    skip_names = set(skip)
+    input_sheets = {*INPUT_SHEET_NAMES, SETTINGS_SHEET_NAME, *INTRANSIT_SHEET_NAMES}
+    sheets: Dict[str, pd.DataFrame] = {}
+    with pd.ExcelFile(_open_source(xlsx)) as xl:
+        for name in xl.sheet_names:
+            if name in skip_names:
+                continue
+            if name in input_sheets:
+                # Ошибка чтения листа, нужного read_input, должна дойти до пользователя
+                sheets[name] = pd.read_excel(xl, name)
+                continue
+            try:
+                sheets[name] = pd.read_excel(xl, name)
+            except Exception:
+                # Прочие листы только копируются в результат — без них расчёт не страдает
+                continue
+    return sheets
+
+
+def read_input(xlsx: ExcelSource) -> Tuple[List[SkuInput], List[InTransitItem]]:
+    # Листы из read_sheets общие с build_output — здесь их не меняем (rename без inplace)
+    sheets = read_sheets(xlsx)
+    input_sheet_name = next((name for name in INPUT_SHEET_NAMES if name in sheets), None)
     if input_sheet_name is None:
         raise BadTemplateError("В файле нет листа 'Input', 'Ввод данных' или 'Ввод'.")
 
-    df_in = pd.read_excel(xl, input_sheet_name)
-    df_in.rename(columns=INPUT_COLUMN_ALIASES, inplace=True)
+    df_in = sheets[input_sheet_name].rename(columns=INPUT_COLUMN_ALIASES)
     df_in = df_in.where(pd.notna(df_in), None)
 
-    # --- Нормализация SKU: удаляем неразрывные пробелы, выравниваем регистр, заменяем длинные дефисы ---
-    def _normalize_sku(s: Any) -> str:
-        if not isinstance(s, str):
-            return s
-        # 1) базовая чистка: обрезка, неразрывные пробелы, длинные дефисы, регистр
-        s = (
-            s.strip()
-            .replace("\xa0", " ")
-            .replace("–", "-")
-            .replace("—", "-")
-            .lower()
-        )
-        # 2) убрать пробелы вокруг слэша: " / ", " /", "/ " -> "/"
-        s = s.replace(" / ", "/").replace(" /", "/").replace("/ ", "/")
-        # 3) схлопнуть лишние пробелы (в т.ч. табы/множественные)
-        s = " ".join(s.split())
-        return s
-
     df_in["sku"] = df_in["sku"].apply(_normalize_sku)
 
-    try:
-        df_settings = pd.read_excel(xl, SETTINGS_SHEET_NAME)
-    except ValueError as e:
-        raise BadTemplateError("В файле нет листа 'Настройки заказа'.") from e
+    if SETTINGS_SHEET_NAME not in sheets:
+        raise BadTemplateError("В файле нет листа 'Настройки заказа'.")
 
-    df_settings.rename(columns=SETTINGS_COLUMN_ALIASES, inplace=True)
+    df_settings = sheets[SETTINGS_SHEET_NAME].rename(columns=SETTINGS_COLUMN_ALIASES)
     df_settings = df_settings.where(pd.notna(df_settings), None)
 
     # --- Читаем лист "Товары в пути" и нормализуем SKU + даты ETA ---
     transit_sheet_name = next(
-        (name for name in INTRANSIT_SHEET_NAMES if name in xl.sheet_names),
+        (name for name in INTRANSIT_SHEET_NAMES if name in sheets),
         None,
     )
     if transit_sheet_name:
-        df_tr = pd.read_excel(xl, transit_sheet_name)
-        df_tr.rename(columns=INTRANSIT_COLUMN_ALIASES, inplace=True)
+        df_tr = sheets[transit_sheet_name].rename(columns=INTRANSIT_COLUMN_ALIASES)
         df_tr = df_tr.where(pd.notna(df_tr), None)
         _ensure_columns(
             df_tr,
@@ -295,7 +363,7 @@ def read_input(xlsx_bytes: bytes) -> Tuple[List[SkuInput], List[InTransitItem]]:
 
         # Приведение ETA к формату datetime.date
         if "eta_cn_msk" in df_tr.columns:
-            df_tr["eta_cn_msk"] = pd.to_datetime(df_tr["eta_cn_msk"], errors="coerce").dt.date
+            df_tr["eta_cn_msk"] = _parse_eta_column(df_tr["eta_cn_msk"])
 
         # Удаляем пустые строки без артикулов
         df_tr = df_tr[df_tr["sku"].notna()]
@@ -322,9 +390,15 @@ def read_input(xlsx_bytes: bytes) -> Tuple[List[SkuInput], List[InTransitItem]]:
     prod_lead_time_days = settings["prod_lead_time_days"]
     lead_time_cn_msk = settings["lead_time_cn_msk"]
     lead_time_msk_mp = settings["lead_time_msk_mp"]
+    # Ограничения SkuInput на общие параметры проверяем один раз, а не в каждой строке
+    settings_valid = (
+        min(prod_lead_time_days, lead_time_cn_msk, lead_time_msk_mp) >= 0
+        and moq_step_default >= 1
+        and 0 <= oos_safety_mp_pct <= 100
+    )
 
     for r in df_in.to_dict("records"):
-        if all(_is_blank(v) for v in r.values()):
+        if _is_blank_row(r):
             continue
         sku = str(r.get("sku") or "").strip()
         if not sku:
@@ -373,7 +447,14 @@ def read_input(xlsx_bytes: bytes) -> Tuple[List[SkuInput], List[InTransitItem]]:
                     sku=sku,
                 )
 
-            items.append(SkuInput(
+            # Значения уже разобраны и проверены: строим модель без повторной валидации pydantic
+            if (
+                not settings_valid
+                or min(stock_ff, stock_mp, safety_stock_mp, safety_stock_ff) < 0
+                or not plan_sales_per_day >= 0
+            ):
+                raise ValueError("Значение вне допустимого диапазона")
+            items.append(SkuInput.model_construct(
                 sku=sku,
                 stock_ff=stock_ff,
                 stock_mp=stock_mp,
@@ -400,10 +481,13 @@ def read_input(xlsx_bytes: bytes) -> Tuple[List[SkuInput], List[InTransitItem]]:
             eta_val = r.get("eta_cn_msk")
             if not eta_val or pd.isna(eta_val):
                 raise ValueError("Пустая или некорректная дата ETA")
+            qty = int(r.get("qty", 0) or 0)
+            if not isinstance(sku_norm, str) or qty < 0:
+                raise ValueError("Некорректный артикул или количество")
             trans.append(
-                InTransitItem(
+                InTransitItem.model_construct(
                     sku=sku_norm,
-                    qty=int(r.get("qty", 0) or 0),
+                    qty=qty,
                     eta_cn_msk=eta_val,
                 )
             )
@@ -469,43 +553,48 @@ def _order_columns(df: pd.DataFrame) -> pd.DataFrame:
     cols = [c for c in _ORDER if c in df.columns] + [c for c in df.columns if c not in _ORDER]
     return df[cols]
 
-def _find_col_idx_by_internal(ws, internal_key: str) -> int | None:
+def _header_positions(ws) -> Dict[str, int]:
+    # Один проход по шапке: и отображаемое, и внутреннее имя -> номер колонки (первое вхождение)
+    positions: Dict[str, int] = {}
     header_rows = list(ws.iter_rows(min_row=1, max_row=1, values_only=True))
     if not header_rows:
-        return None
+        return positions
     for idx, value in enumerate(header_rows[0], start=1):
-        if value == internal_key:
-            return idx
-        if RECOMMENDATION_DISPLAY_TO_INTERNAL.get(value) == internal_key:
-            return idx
-    return None
+        if value is None:
+            continue
+        positions.setdefault(value, idx)
+        internal = RECOMMENDATION_DISPLAY_TO_INTERNAL.get(value)
+        if internal is not None:
+            positions.setdefault(internal, idx)
+    return positions
 
 
 def _apply_formats_localized(ws):
-    idx_order  = _find_col_idx_by_internal(ws, "order_qty")
-    idx_status = _find_col_idx_by_internal(ws, "stock_status")
-    idx_short  = _find_col_idx_by_internal(ws, "shortage")
-    idx_cov    = _find_col_idx_by_internal(ws, "coverage")
-    idx_sku    = _find_col_idx_by_internal(ws, "sku")
-    idx_thr    = _find_col_idx_by_internal(ws, "oos_threshold")
-    idx_plan   = _find_col_idx_by_internal(ws, "current_plan")
+    pos = _header_positions(ws)
+    idx_order  = pos.get("order_qty")
+    idx_status = pos.get("stock_status")
+    idx_short  = pos.get("shortage")
+    idx_cov    = pos.get("coverage")
+    idx_sku    = pos.get("sku")
+    idx_thr    = pos.get("oos_threshold")
+    idx_plan   = pos.get("current_plan")
     risk_cols = [
-        _find_col_idx_by_internal(ws, "stock_before_1"),
-        _find_col_idx_by_internal(ws, "stock_after_1"),
-        _find_col_idx_by_internal(ws, "stock_before_2"),
-        _find_col_idx_by_internal(ws, "stock_after_2"),
-        _find_col_idx_by_internal(ws, "stock_before_3"),
-        _find_col_idx_by_internal(ws, "stock_after_3"),
-        _find_col_idx_by_internal(ws, "eoh"),
-        _find_col_idx_by_internal(ws, "stock_before_po"),
+        pos.get("stock_before_1"),
+        pos.get("stock_after_1"),
+        pos.get("stock_before_2"),
+        pos.get("stock_after_2"),
+        pos.get("stock_before_3"),
+        pos.get("stock_after_3"),
+        pos.get("eoh"),
+        pos.get("stock_before_po"),
     ]
     risk_cols = [c for c in risk_cols if c]
 
     reco_cols = [
-        _find_col_idx_by_internal(ws, "reco_before_1p"),
-        _find_col_idx_by_internal(ws, "reco_before_2p"),
-        _find_col_idx_by_internal(ws, "reco_before_3p"),
-        _find_col_idx_by_internal(ws, "reco_before_po"),
+        pos.get("reco_before_1p"),
+        pos.get("reco_before_2p"),
+        pos.get("reco_before_3p"),
+        pos.get("reco_before_po"),
     ]
     reco_cols = [c for c in reco_cols if c]
 
@@ -790,31 +879,28 @@ def generate_input_template() -> io.BytesIO:
     buf.seek(0)
     return buf
 
-def build_output(xlsx_in: bytes, recs: List[Recommendation]) -> bytes:
+def build_output(xlsx_in: ExcelSource, recs: List[Recommendation]) -> bytes:
     # Конвертируем в DataFrame и отсортируем колонки
-    df_rec = pd.DataFrame([r.model_dump() for r in recs])
+    df_rec = pd.DataFrame([asdict(r) for r in recs])
     if not df_rec.empty:
         df_rec = _order_columns(df_rec)
 
-    in_buf = io.BytesIO(xlsx_in)
+    # Книгу разбираем один раз (или берём уже прочитанные в read_input листы)
+    sheets = read_sheets(xlsx_in)
     out_buf = io.BytesIO()
 
     moq_value: float = 1
     try:
-        with pd.ExcelFile(in_buf) as xl_settings:
-            if SETTINGS_SHEET_NAME in xl_settings.sheet_names:
-                df_settings_raw = pd.read_excel(xl_settings, SETTINGS_SHEET_NAME)
-                df_settings = df_settings_raw.rename(columns=SETTINGS_COLUMN_ALIASES)
-                if "moq_step_default" in df_settings.columns:
-                    moq_series = pd.to_numeric(df_settings["moq_step_default"], errors="coerce").dropna()
-                    if not moq_series.empty:
-                        first_value = moq_series.iloc[0]
-                        if pd.notna(first_value) and first_value > 0:
-                            moq_value = float(first_value)
+        if SETTINGS_SHEET_NAME in sheets:
+            df_settings = sheets[SETTINGS_SHEET_NAME].rename(columns=SETTINGS_COLUMN_ALIASES)
+            if "moq_step_default" in df_settings.columns:
+                moq_series = pd.to_numeric(df_settings["moq_step_default"], errors="coerce").dropna()
+                if not moq_series.empty:
+                    first_value = moq_series.iloc[0]
+                    if pd.notna(first_value) and first_value > 0:
+                        moq_value = float(first_value)
     except Exception:
         moq_value = 1
-    finally:
-        in_buf.seek(0)
 
     if pd.isna(moq_value) or moq_value <= 0:
         moq_value = 1
@@ -904,55 +990,34 @@ def build_output(xlsx_in: bytes, recs: List[Recommendation]) -> bytes:
         # 2) Пишем лист "Рекомендации": подтягиваем current_plan и onhand из входного листа
         df_out = df_rec.copy()
         if not df_out.empty:
-            def _normalize_sku(value: Any) -> Any:
-                if not isinstance(value, str):
-                    return value
-                normalized = (
-                    value.strip()
-                    .replace("\xa0", " ")
-                    .replace("–", "-")
-                    .replace("—", "-")
-                    .lower()
-                )
-                normalized = (
-                    normalized.replace(" / ", "/")
-                    .replace(" /", "/")
-                    .replace("/ ", "/")
-                )
-                return " ".join(normalized.split())
-
             plan_map = None
             onhand_map = None
             try:
-                with pd.ExcelFile(in_buf) as xl_in:
-                    input_sheet = next((name for name in INPUT_SHEET_NAMES if name in xl_in.sheet_names), None)
-                    if input_sheet:
-                        df_in = pd.read_excel(xl_in, input_sheet)
-                        df_in = df_in.rename(columns=INPUT_COLUMN_ALIASES)
-                        if "sku" in df_in.columns:
-                            df_in["sku"] = df_in["sku"].apply(_normalize_sku)
-                            for col in ("stock_ff", "stock_mp", "plan_sales_per_day"):
-                                if col in df_in.columns:
-                                    df_in[col] = pd.to_numeric(df_in[col], errors="coerce")
-                            agg_spec = {}
-                            if "plan_sales_per_day" in df_in.columns:
-                                agg_spec["plan_sales_per_day"] = "max"
-                            for col in ("stock_ff", "stock_mp"):
-                                if col in df_in.columns:
-                                    agg_spec[col] = "sum"
-                            if agg_spec:
-                                grp = df_in.groupby("sku", as_index=True).agg(agg_spec)
-                                if "plan_sales_per_day" in grp.columns:
-                                    plan_map = grp["plan_sales_per_day"]
-                                if "stock_ff" in grp.columns or "stock_mp" in grp.columns:
-                                    stock_ff = grp["stock_ff"] if "stock_ff" in grp.columns else pd.Series(0, index=grp.index)
-                                    stock_mp = grp["stock_mp"] if "stock_mp" in grp.columns else pd.Series(0, index=grp.index)
-                                    onhand_map = stock_ff.fillna(0) + stock_mp.fillna(0)
+                input_sheet = next((name for name in INPUT_SHEET_NAMES if name in sheets), None)
+                if input_sheet:
+                    df_in = sheets[input_sheet].rename(columns=INPUT_COLUMN_ALIASES)
+                    if "sku" in df_in.columns:
+                        df_in["sku"] = df_in["sku"].apply(_normalize_sku)
+                        for col in ("stock_ff", "stock_mp", "plan_sales_per_day"):
+                            if col in df_in.columns:
+                                df_in[col] = pd.to_numeric(df_in[col], errors="coerce")
+                        agg_spec = {}
+                        if "plan_sales_per_day" in df_in.columns:
+                            agg_spec["plan_sales_per_day"] = "max"
+                        for col in ("stock_ff", "stock_mp"):
+                            if col in df_in.columns:
+                                agg_spec[col] = "sum"
+                        if agg_spec:
+                            grp = df_in.groupby("sku", as_index=True).agg(agg_spec)
+                            if "plan_sales_per_day" in grp.columns:
+                                plan_map = grp["plan_sales_per_day"]
+                            if "stock_ff" in grp.columns or "stock_mp" in grp.columns:
+                                stock_ff = grp["stock_ff"] if "stock_ff" in grp.columns else pd.Series(0, index=grp.index)
+                                stock_mp = grp["stock_mp"] if "stock_mp" in grp.columns else pd.Series(0, index=grp.index)
+                                onhand_map = stock_ff.fillna(0) + stock_mp.fillna(0)
             except Exception:
                 plan_map = None
                 onhand_map = None
-            finally:
-                in_buf.seek(0)
 
             if plan_map is not None:
                 df_out["current_plan"] = df_out["sku"].map(plan_map)
@@ -1006,21 +1071,20 @@ def build_output(xlsx_in: bytes, recs: List[Recommendation]) -> bytes:
             ws_log = w.book["Log"]
             ws_log.sheet_state = "hidden"
 
-        # 4) Затем переносим прочие исходные листы, раскрывая книгу один раз
+        # 4) Затем переносим прочие исходные листы из уже прочитанной книги
         try:
-            with pd.ExcelFile(in_buf) as xl:
-                skip = {"Recommendations", "Рекомендации", "Log", "Заказ на фабрику"}
-                for name in xl.sheet_names:
-                    if name in skip:
-                        continue
-                    new_name = "Ввод данных" if name == "Ввод" else name
-                    pd.read_excel(xl, name).to_excel(w, sheet_name=new_name, index=False)
+            for name, df_sheet in sheets.items():
+                if name in OUTPUT_SHEET_NAMES:
+                    continue
+                new_name = "Ввод данных" if name == "Ввод" else name
+                df_sheet.to_excel(w, sheet_name=new_name, index=False)
         except Exception:
             pass
 
     return out_buf.getvalue()
 
 def process_excel(xlsx_bytes: bytes) -> bytes:
-    items, trans = read_input(xlsx_bytes)
+    sheets = read_sheets(xlsx_bytes)
+    items, trans = read_input(sheets)
     recs = calculate(items, trans)
-    return build_output(xlsx_bytes, recs)
+    return build_output(sheets, recs)
@@ -1,24 +1,57 @@
 # app/main.py
+from collections import deque
 from datetime import datetime
 from io import BytesIO
 from pathlib import Path
 
 from fastapi import FastAPI, Request, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
 
 from engine.calc import calculate
 from engine.config import ALGO_VERSION
-from adapters.excel_io import BadTemplateError, build_output, generate_input_template, read_input
+from adapters.excel_io import BadTemplateError, build_output, generate_input_template, read_input, read_sheets
 import uvicorn
 import logging
 
 LAST_RESULTS_DIR = Path("last_results")
 LAST_RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+LAST_RESULTS_LIMIT = 5
+
+
+def _load_last_results() -> deque[Path]:
+    # Один проход по папке при старте; дальше список ведём в памяти
+    try:
+        files = sorted(
+            [p for p in LAST_RESULTS_DIR.glob("*.xlsx") if p.is_file()],
+            key=lambda p: p.stat().st_mtime,
+        )
+    except Exception:
+        files = []
+    for old in files[:-LAST_RESULTS_LIMIT]:
+        try:
+            old.unlink()
+        except OSError:
+            continue
+    return deque(files[-LAST_RESULTS_LIMIT:], maxlen=LAST_RESULTS_LIMIT)
+
+
+# Последние результаты: от старых к новым
+_RECENT: deque[Path] = _load_last_results()
 
 
 app = FastAPI(title="WB Order Engine")
+# Сжимаем HTML/JSON; xlsx уже zip-архив, повторно его не жмём
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=1024,
+    exclude_content_types=DEFAULT_EXCLUDED_CONTENT_TYPES
+    + ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",),
+)
 
 # --- Шаблоны и статика ---
 templates = Jinja2Templates(directory="app/templates")
@@ -66,10 +99,13 @@ async def upload_excel(file: UploadFile = File(...)):
         if not file.filename.lower().endswith(".xlsx"):
             raise HTTPException(status_code=400, detail="Ожидается .xlsx файл.")
 
-        content = await file.read()
-        items, in_transit = read_input(content)
-        recs = calculate(items, in_transit)
-        out_bytes = build_output(content, recs)
+        # Читаем из SpooledTemporaryFile напрямую, без копии всей загрузки в bytes;
+        # книга разбирается один раз и дальше передаётся в read_input/build_output.
+        # Разбор, расчёт и сборка Excel идут в пуле потоков, чтобы не блокировать event loop
+        sheets = await run_in_threadpool(read_sheets, file.file)
+        items, in_transit = await run_in_threadpool(read_input, sheets)
+        recs = await run_in_threadpool(calculate, items, in_transit)
+        out_bytes = await run_in_threadpool(build_output, sheets, recs)
 
         now = datetime.now().strftime("%Y%m%d_%H%M%S")
         fname = f"Planner_Recommendations_{now}.xlsx"
@@ -77,19 +113,14 @@ async def upload_excel(file: UploadFile = File(...)):
         with open(result_path, "wb") as f_out:
             f_out.write(out_bytes)
 
-        try:
-            files = sorted(
-                [p for p in LAST_RESULTS_DIR.glob("*.xlsx") if p.is_file()],
-                key=lambda p: p.stat().st_mtime,
-                reverse=True,
-            )
-            for old in files[5:]:
-                try:
-                    old.unlink()
-                except OSError:
-                    continue
-        except Exception:
-            pass
+        if result_path in _RECENT:
+            _RECENT.remove(result_path)
+        if len(_RECENT) == _RECENT.maxlen:
+            try:
+                _RECENT[0].unlink()
+            except OSError:
+                pass
+        _RECENT.append(result_path)
 
         buffer = BytesIO(out_bytes)
         return StreamingResponse(
@@ -111,17 +142,8 @@ async def upload_excel(file: UploadFile = File(...)):
 
 @app.get("/last_results")
 async def list_last_results():
-    try:
-        files = sorted(
-            [p for p in LAST_RESULTS_DIR.glob("*.xlsx") if p.is_file()],
-            key=lambda p: p.stat().st_mtime,
-            reverse=True,
-        )[:5]
-    except Exception:
-        files = []
-
     result = []
-    for p in files:
+    for p in reversed(_RECENT):
         try:
             stat = p.stat()
             result.append(
@@ -142,18 +164,11 @@ async def download_last_result(filename: str):
     if not path.is_file():
         raise HTTPException(status_code=404, detail="Файл не найден")
 
-    def _iterfile():
-        with open(path, "rb") as f:
-            while True:
-                chunk = f.read(8192)
-                if not chunk:
-                    break
-                yield chunk
-
-    return StreamingResponse(
-        _iterfile(),
+    # FileResponse отдаёт файл через sendfile, если сервер это поддерживает
+    return FileResponse(
+        path,
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        filename=filename,
     )
 
 
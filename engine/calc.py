@@ -1,6 +1,9 @@
-from datetime import date, timedelta
-import math
-from typing import Iterable, List, Optional, Tuple
+from bisect import bisect_left, bisect_right
+from datetime import date
+from itertools import accumulate
+from math import ceil
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from .models import SkuInput, InTransitItem, Recommendation
 from .config import ALGO_VERSION
@@ -10,89 +13,128 @@ def _today() -> date:
     return date.today()
 
 
-def _calc_H(x: SkuInput) -> int:
-    return x.prod_lead_time_days + x.lead_time_cn_msk + x.lead_time_msk_mp
+def _calc_H(prod_lead_time_days: int, lead_time_cn_msk: int, lead_time_msk_mp: int) -> int:
+    return prod_lead_time_days + lead_time_cn_msk + lead_time_msk_mp
 
 
-def _eta_to_mp(it: InTransitItem, lt_msk_mp: int) -> date:
-    return it.eta_cn_msk + timedelta(days=lt_msk_mp)
+# Товары в пути по одному SKU: (дни от сегодня до прибытия на ФФ по возрастанию, qty, накопленные qty с 0)
+_SkuTransit = Tuple[List[int], List[int], List[int]]
 
 
-def _inbound_within_H(
-    sku: str,
+def _group_by_sku(
     items: Iterable[InTransitItem],
+    today_ord: int,
+) -> Dict[str, _SkuTransit]:
+    # Один проход по товарам в пути: для каждого SKU пары (дней от сегодня до прибытия на ФФ, qty).
+    # День прихода на МП = это смещение + lead_time_msk_mp конкретного SKU.
+    # Смещение — разность ординалов (int), без промежуточных timedelta
+    pairs_by_sku: Dict[str, List[Tuple[int, int]]] = {}
+    for it in items:
+        pairs_by_sku.setdefault(it.sku, []).append((it.eta_cn_msk.toordinal() - today_ord, it.qty))
+    by_sku: Dict[str, _SkuTransit] = {}
+    for sku, pairs in pairs_by_sku.items():
+        # Сортируем один раз (устойчиво, по дню): сдвиг на lead_time порядок не меняет
+        pairs.sort(key=itemgetter(0))
+        qtys = [qty for _, qty in pairs]
+        by_sku[sku] = ([day for day, _ in pairs], qtys, [0, *accumulate(qtys)])
+    return by_sku
+
+
+def _inbound_within_H(
+    transit: _SkuTransit,
     lt_msk_mp: int,
     H: int,
-    today: date,
-) -> Tuple[int, Optional[date]]:
-    horizon_mp = today + timedelta(days=H)
-    inbound = 0
-    next_eta_mp: Optional[date] = None
-    for it in items:
-        if it.sku != sku:
-            continue
-        eta_mp = _eta_to_mp(it, lt_msk_mp)
-        if eta_mp < today:
-            continue
-        if eta_mp <= horizon_mp:
-            inbound += it.qty
-        if next_eta_mp is None or eta_mp < next_eta_mp:
-            next_eta_mp = eta_mp
-    return inbound, next_eta_mp
+) -> Tuple[int, List[Tuple[int, int]]]:
+    # Приход на МП в [0, H] <=> день на ФФ в [-lt_msk_mp, H - lt_msk_mp]: границы ищем bisect'ом,
+    # сумму берём из накопленных qty. events (день на МП, qty) уже упорядочены по дню
+    days, qtys, cum_qty = transit
+    lo = bisect_left(days, -lt_msk_mp)
+    hi = bisect_right(days, H - lt_msk_mp)
+    events = [(days[i] + lt_msk_mp, qtys[i]) for i in range(lo, hi)]
+    return cum_qty[hi] - cum_qty[lo], events
 
 
 def _order_qty(shortage: float, moq_step: int) -> int:
     if shortage <= 0:
         return 0
-    return int(math.ceil(shortage / moq_step) * moq_step)
+    # Ближайшее кратное moq_step сверху: целочисленное деление без float-округлений
+    units = ceil(shortage)
+    return (units + moq_step - 1) // moq_step * moq_step
 
 
-def _min_stock_with_constant_rate(
-    on_hand: float,
+def _event_spans(
     events: List[Tuple[int, int]],
     H: int,
+) -> Tuple[List[Tuple[int, int]], int]:
+    # (дней до поставки от предыдущей, qty) по отсортированным событиям + хвост до H
+    spans: List[Tuple[int, int]] = []
+    prev_day = 0
+    for day, qty in events:
+        spans.append((max(day - prev_day, 0), qty))
+        prev_day = day
+    return spans, max(H - prev_day, 0)
+
+
+def _min_stock_with_constant_rate(
+    on_hand: float,
+    spans: List[Tuple[int, int]],
+    d_tail: int,
     rate: float,
 ) -> float:
     stock = on_hand
     min_stock = stock
-    prev_day = 0
-    for day, qty in events:
-        span = max(day - prev_day, 0)
+    for span, qty in spans:
         stock -= rate * span
         min_stock = min(min_stock, stock)
         stock += qty
-        prev_day = day
-    span = max(H - prev_day, 0)
-    stock -= rate * span
+    stock -= rate * d_tail
     min_stock = min(min_stock, stock)
     return min_stock
 
 
+def _safe_rate(S0: float, d: int, p_current: float, thr: float) -> float:
+    if d <= 0:
+        return p_current
+    raw = (S0 - thr) / float(d)
+    # Для raw > 0 усечение int() совпадает с floor(); отрицательное сразу даёт 0
+    r_star = float(int(raw)) if raw > 0 else 0.0
+    return min(r_star, p_current)
+
+
 def calculate(inputs: List[SkuInput], in_transit: List[InTransitItem]) -> List[Recommendation]:
-    t = _today()
+    # Дата расчёта фиксируется один раз на весь пакет
+    t_ord = _today().toordinal()
     recs: List[Recommendation] = []
+    by_sku = _group_by_sku(in_transit, t_ord)
     for x in inputs:
-        H = _calc_H(x)
-        inbound, _ = _inbound_within_H(
-            x.sku, in_transit, x.lead_time_msk_mp, H, t
-        )
-        coverage = x.stock_ff + x.stock_mp + inbound
-
-        events: List[Tuple[int, int]] = []
-        for it in in_transit:
-            if it.sku != x.sku:
-                continue
-            eta_mp_i = _eta_to_mp(it, x.lead_time_msk_mp)
-            day_offset = (eta_mp_i - t).days
-            if 0 <= day_offset <= H:
-                events.append((day_offset, it.qty))
-        events.sort(key=lambda z: z[0])
-
+        # Поля SKU читаем один раз в локальные переменные
+        sku = x.sku
+        stock_total = x.stock_ff + x.stock_mp
         plan = float(x.plan_sales_per_day)
-        on_hand = float(x.stock_ff + x.stock_mp)
-        oos_threshold = (x.oos_safety_mp_pct / 100.0) * x.safety_stock_mp
+        ssm = x.safety_stock_mp
+        moq = x.moq_step
+        lt_mp = x.lead_time_msk_mp
+
+        H = _calc_H(x.prod_lead_time_days, x.lead_time_cn_msk, lt_mp)
+        transit = by_sku.get(sku)
+        if transit is None:
+            # Товаров в пути по SKU нет: поиск окна не нужен
+            inbound, events = 0, []
+        else:
+            inbound, events = _inbound_within_H(transit, lt_mp, H)
+        coverage = stock_total + inbound
 
-        min_stock = _min_stock_with_constant_rate(on_hand, events, H, plan)
+        on_hand = float(stock_total)
+        oos_threshold = (x.oos_safety_mp_pct / 100.0) * ssm
+
+        if events:
+            # Интервалы между поставками считаем один раз: они общие для проверки и «лесенки»
+            spans, d_tail = _event_spans(events, H)
+            min_stock = _min_stock_with_constant_rate(on_hand, spans, d_tail, plan)
+        else:
+            # Поставок в горизонте нет: запас только убывает, минимум — в конце горизонта
+            spans, d_tail = [], H
+            min_stock = on_hand - plan * H
         if min_stock < oos_threshold - 1e-9:
             stock_status = "⚠️ Не хватает"
         else:
@@ -107,17 +149,9 @@ def calculate(inputs: List[SkuInput], in_transit: List[InTransitItem]) -> List[R
         reco_before_1p = reco_before_2p = reco_before_3p = None
 
         S = on_hand
-        prev_day = 0
         demand_used = 0.0
 
-        def _safe_rate(S0: float, d: int, p_current: float, thr: float) -> float:
-            if d <= 0:
-                return p_current
-            r_star = max(0.0, math.floor((S0 - thr) / float(d)))
-            return float(min(r_star, p_current))
-
-        for idx, (day_offset, qty) in enumerate(events, start=1):
-            span = max(day_offset - prev_day, 0)
+        for idx, (span, qty) in enumerate(spans, start=1):
             if span > 0:
                 stock_if_plan = S - plan * span
                 if stock_if_plan >= oos_threshold - 1e-9:
@@ -129,7 +163,6 @@ def calculate(inputs: List[SkuInput], in_transit: List[InTransitItem]) -> List[R
                 demand_used += r_use * span
                 stock_before = S - r_use * span
             else:
-                r_use = plan
                 reco_val = None
                 stock_before = S
             stock_after = max(stock_before, 0.0) + qty
@@ -145,9 +178,7 @@ def calculate(inputs: List[SkuInput], in_transit: List[InTransitItem]) -> List[R
                 reco_before_3p = reco_val
 
             S = stock_after
-            prev_day = day_offset
 
-        d_tail = max(H - prev_day, 0)
         if d_tail > 0:
             stock_if_plan = S - plan * d_tail
             if stock_if_plan >= oos_threshold - 1e-9:
@@ -159,15 +190,14 @@ def calculate(inputs: List[SkuInput], in_transit: List[InTransitItem]) -> List[R
             demand_used += r_tail * d_tail
             stock_before_po = S - r_tail * d_tail
         else:
-            r_tail = plan
             stock_before_po = S
             reco_before_po = None
 
         eoh = stock_before_po
         demand_H = demand_used
-        target = demand_H + x.safety_stock_mp + x.safety_stock_ff
+        target = demand_H + ssm + x.safety_stock_ff
         shortage = max(0.0, target - coverage)
-        order_qty = _order_qty(shortage, x.moq_step)
+        order_qty = _order_qty(shortage, moq)
 
         if order_qty > 0:
             stock_after_po = max(stock_before_po, 0.0) + float(order_qty)
@@ -176,14 +206,14 @@ def calculate(inputs: List[SkuInput], in_transit: List[InTransitItem]) -> List[R
         eop_first = stock_after_1
 
         recs.append(Recommendation(
-            sku=x.sku,
+            sku=sku,
             H_days=H,
             demand_H=demand_H,
-            inbound=inbound,
-            coverage=coverage,
+            inbound=float(inbound),
+            coverage=float(coverage),
             target=target,
             shortage=shortage,
-            moq_step=x.moq_step,
+            moq_step=moq,
             order_qty=order_qty,
             stock_status=stock_status,
             algo_version=ALGO_VERSION,
@@ -2,12 +2,16 @@ from __future__ import annotations
 
 from datetime import datetime
 from io import BytesIO
-from typing import Iterable, Optional, Sequence
+from operator import attrgetter
+from typing import Iterable, List, Optional, Sequence
 
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
 
 from .config import ALGO_VERSION
+from .models import Recommendation
 
 
 # Важно поддерживать соответствие с adapters.excel_io.RECOMMENDATION_COLUMN_ALIASES
@@ -27,6 +31,24 @@ RECOMMENDATION_HEADERS = [
     "Версия алгоритма",
 ]
 
+# Поля Recommendation в порядке RECOMMENDATION_HEADERS
+RECOMMENDATION_FIELDS = (
+    "sku",
+    "H_days",
+    "demand_H",
+    "inbound",
+    "coverage",
+    "target",
+    "shortage",
+    "moq_step",
+    "order_qty",
+    "stock_status",
+    "eoh",
+    "eop_first",
+    "algo_version",
+)
+_recommendation_row = attrgetter(*RECOMMENDATION_FIELDS)
+
 LOG_HEADERS = [
     "generated_at",
     "algo_version",
@@ -37,63 +59,64 @@ LOG_HEADERS = [
 ]
 
 
-def _auto_width(worksheet, minimum: int = 10, maximum: int = 50) -> None:
-    for column_cells in worksheet.columns:
-        max_len = 0
-        for cell in column_cells:
-            if cell.value is None:
-                continue
-            max_len = max(max_len, len(str(cell.value)))
+def _track_widths(col_max: List[int], row: Sequence) -> None:
+    # Максимальная длина значения по колонкам копится при добавлении строк — без повторного обхода листа
+    for idx, value in enumerate(row):
+        if value is None:
+            continue
+        length = len(str(value))
+        if length > col_max[idx]:
+            col_max[idx] = length
+
+
+def _apply_widths(worksheet, col_max: Sequence[int], minimum: int = 10, maximum: int = 50) -> None:
+    for idx, max_len in enumerate(col_max, start=1):
         width = max(minimum, max_len + 2)
-        worksheet.column_dimensions[column_cells[0].column_letter].width = min(width, maximum)
+        worksheet.column_dimensions[get_column_letter(idx)].width = min(width, maximum)
+
+
+def _header_cells(worksheet, headers: Sequence[str], font: Font) -> List[WriteOnlyCell]:
+    cells = []
+    for header in headers:
+        cell = WriteOnlyCell(worksheet, value=header)
+        cell.font = font
+        cells.append(cell)
+    return cells
 
 
 def recommendations_to_excel(
-    recs: Iterable,
+    recs: Iterable[Recommendation],
     *,
     sku_count: Optional[int] = None,
     in_transit_count: int = 0,
     total_volume: Optional[int] = None,
     log_items: Optional[Sequence] = None,
 ) -> BytesIO:
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Planner_Recommendations"
-
+    # Потоковая книга: ячейки не хранятся в памяти, но ширины колонок нужно задать до первой строки,
+    # поэтому строки сначала собираются, затем пишутся
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Planner_Recommendations")
     header_font = Font(bold=True)
-    ws.append(RECOMMENDATION_HEADERS)
-    for cell in ws[1]:
-        cell.font = header_font
-
-    recs_list = list(recs)
-    for r in recs_list:
-        ws.append([
-            getattr(r, "sku", None),
-            getattr(r, "H_days", None),
-            getattr(r, "demand_H", None),
-            getattr(r, "inbound", None),
-            getattr(r, "coverage", None),
-            getattr(r, "target", None),
-            getattr(r, "shortage", None),
-            getattr(r, "moq_step", None),
-            getattr(r, "order_qty", None),
-            getattr(r, "stock_status", None),
-            getattr(r, "eoh", None),
-            getattr(r, "eop_first", None),
-            getattr(r, "algo_version", ALGO_VERSION),
-        ])
-
-    _auto_width(ws, minimum=10, maximum=40)
 
-    log_ws = wb.create_sheet("Log")
-    log_ws.append(LOG_HEADERS)
-    for cell in log_ws[1]:
-        cell.font = header_font
+    rows = []
+    col_max = [len(h) for h in RECOMMENDATION_HEADERS]
+    # Один проход по recs: строки, число SKU и суммарный объём считаются вместе
+    volume = 0
+    for r in recs:
+        row = _recommendation_row(r)
+        _track_widths(col_max, row)
+        rows.append(row)
+        volume += r.order_qty or 0
+
+    _apply_widths(ws, col_max, minimum=10, maximum=40)
+    ws.append(_header_cells(ws, RECOMMENDATION_HEADERS, header_font))
+    for row in rows:
+        ws.append(row)
 
     generated_at = datetime.now().isoformat()
-    sku_total = sku_count if sku_count is not None else len(recs_list)
+    sku_total = sku_count if sku_count is not None else len(rows)
     if total_volume is None:
-        total_volume = sum((getattr(r, "order_qty", 0) or 0) for r in recs_list)
+        total_volume = volume
 
     stocks_info = ""
     if log_items:
@@ -108,15 +131,20 @@ def recommendations_to_excel(
             parts.append(f"{sku}: {stocks}" if sku else stocks)
         stocks_info = "; ".join(parts)
 
-    log_ws.append([
+    log_row = [
         generated_at,
         ALGO_VERSION,
         sku_total,
         in_transit_count,
         total_volume,
         stocks_info,
-    ])
-    _auto_width(log_ws, minimum=15, maximum=50)
+    ]
+    log_ws = wb.create_sheet("Log")
+    log_col_max = [len(h) for h in LOG_HEADERS]
+    _track_widths(log_col_max, log_row)
+    _apply_widths(log_ws, log_col_max, minimum=15, maximum=50)
+    log_ws.append(_header_cells(log_ws, LOG_HEADERS, header_font))
+    log_ws.append(log_row)
 
     buf = BytesIO()
     wb.save(buf)
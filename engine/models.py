@@ -1,3 +1,4 @@
+from dataclasses import dataclass
 from datetime import date
 from typing import Optional
 
@@ -24,7 +25,9 @@ class InTransitItem(BaseModel):
     eta_cn_msk: date
 
 
-class Recommendation(BaseModel):
+# Результат расчёта: значения считает calculate(), валидация не нужна — обычный dataclass со slots
+@dataclass(slots=True)
+class Recommendation:
     sku: str
     H_days: int
     demand_H: float